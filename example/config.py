@@ -8,6 +8,14 @@ from xkeysnail.transform import *
 # define timeout (milliseconds) for multipurpose_modmap
 define_timeout(1000)
 
+# send the modifier of a multipurpose key held alone for this long (milliseconds)
+# instead of waiting for another key to be pressed
+#define_multipurpose_hold_threshold(200)
+
+# group the key transitions of a remapped combo into as few SYN_REPORT frames
+# as possible ("combo") instead of one frame per transition ("key", default)
+#define_combo_sync("combo")
+
 ## use Shingeta-Hairetsu for ANSI US physical keyboard layout
 #shingeta_config_path = os.path.dirname(__file__) + '/shingeta_ansi_us.py'
 ## or use the following line when the file is stored under `$HOME/.config/xkeysnail/`
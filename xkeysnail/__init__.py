@@ -39,7 +39,22 @@ def cli_main():
                         help='watch keyboard devices plug in ')
     parser.add_argument('-q', '--quiet', dest='quiet', action='store_true',
                         help='suppress output of key events')
+    parser.add_argument('--asyncio', dest='asyncio', action='store_true',
+                        help='run the event loop on asyncio')
+    parser.add_argument('--raw-reader', dest='raw_reader', action='store_true',
+                        help='decode input events from a raw buffer instead of python-evdev objects')
+    parser.add_argument('--latency', dest='latency', action='store_true',
+                        help='record keystroke latencies (dumped on SIGUSR1 and at exit)')
+    parser.add_argument('--profile', dest='profile', metavar='stats_file', type=str,
+                        help='profile the handling of input events and write pstats to stats_file '
+                             '(SIGUSR2 writes and stops, or restarts, profiling)')
+    parser.add_argument('--realtime', dest='realtime', action='store_true',
+                        help='run the event loop with SCHED_FIFO, locked memory and a frozen GC')
+    parser.add_argument('--cpu', dest='cpu', metavar='CPU', type=int,
+                        help='pin xkeysnail to a CPU (with --realtime)')
     args = parser.parse_args()
+    if args.cpu is not None and not args.realtime:
+        parser.error("--cpu requires --realtime")
 
     # Make sure that the /dev/uinput device exists
     if not uinput_device_exists():
@@ -61,6 +76,18 @@ Make sure that you have executed xkeysnail with root privilege such as
     # Load configuration file
     eval_file(args.config)
 
+    if args.realtime:
+        from xkeysnail.realtime import enter_realtime_mode, print_realtime_report
+        print_realtime_report(enter_realtime_mode(args.cpu))
+
+    if args.latency:
+        from xkeysnail.latency import enable_latency_tracking
+        enable_latency_tracking()
+
+    if args.profile:
+        from xkeysnail.profiler import enable_profiler
+        enable_profiler(args.profile)
+
     # Enter event loop
     from xkeysnail.input import loop
-    loop(args.devices, args.watch, args.quiet)
+    loop(args.devices, args.watch, args.quiet, args.asyncio, args.raw_reader)
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
 from evdev import ecodes, InputDevice, list_devices
-from select import select
+import fcntl
+import os
+import selectors
+import struct
+import time
 from sys import exit
-from .transform import on_event
-from .output import send_event
+from .transform import on_event, on_key_event, start_focus_tracking, update_focus
+from .output import send_event, send_raw_event, queue_pending_events, drop_pending_events
+from .scheduler import get_signal_handlers, get_timeout, run_expired_timers, run_signal_handlers
+from .latency import begin_keystroke, end_keystroke, note_read
+from .profiler import is_profiler_enabled, profiled
 from .key import Key
 
 __author__ = 'zh'
@@ -97,52 +104,150 @@ def in_device_list(fn, devices):
     return False
 
 
-def loop(device_matches, device_watch, quiet):
+# File objects watched by loop() with their handlers; devices are registered
+# once and added/removed as they come and go
+_selector = selectors.DefaultSelector()
+
+# asyncio event loop running the handlers when loop() uses the asyncio engine
+_event_loop = None
+_timer_handle = None
+
+
+def register(fileobj, handler):
+    """Watch fileobj (an object with fileno() or a file descriptor) in the
+    event loop and call handler(fileobj) whenever it becomes readable"""
+    _selector.register(fileobj, selectors.EVENT_READ, handler)
+    if _event_loop:
+        _event_loop.add_reader(fileobj, run_handler, handler, fileobj)
+
+
+def unregister(fileobj):
+    _selector.unregister(fileobj)
+    if _event_loop:
+        _event_loop.remove_reader(fileobj)
+
+
+# Buffer of read_raw_events() holding struct input_event records
+# {struct timeval time; __u16 type; __u16 code; __s32 value;}, viewed as
+# arrays of u16 and s32 to decode the records in place
+_INPUT_EVENT_SIZE = struct.calcsize("llHHi")
+_TYPE_INDEX = struct.calcsize("ll") // 2
+_CODE_INDEX = _TYPE_INDEX + 1
+_VALUE_INDEX = struct.calcsize("llHH") // 4
+_raw_buffer = bytearray(_INPUT_EVENT_SIZE * 64)
+_raw_long = memoryview(_raw_buffer).cast("l")
+_raw_u16 = memoryview(_raw_buffer).cast("H")
+_raw_s32 = memoryview(_raw_buffer).cast("i")
+
+# _IOW('E', 0xa0, int): set the clock of event timestamps
+EVIOCSCLOCKID = 0x400445a0
+
+# fds of the devices whose event timestamps are on the monotonic clock
+_monotonic_device_fds = set()
+
+
+def use_monotonic_clock(device):
+    """Make the kernel timestamp events of device with CLOCK_MONOTONIC, so that
+    key timings can be measured from the events rather than when they are read"""
+    try:
+        fcntl.ioctl(device.fd, EVIOCSCLOCKID, struct.pack("i", time.CLOCK_MONOTONIC))
+        _monotonic_device_fds.add(device.fd)
+    except OSError:
+        # Keep using the time events are handled at
+        _monotonic_device_fds.discard(device.fd)
+
+
+def read_raw_events(device, quiet):
+    """Read events of device without creating InputEvent objects"""
+    long_ = _raw_long
+    u16 = _raw_u16
+    s32 = _raw_s32
+    long_stride = _INPUT_EVENT_SIZE // _raw_long.itemsize
+    u16_stride = _INPUT_EVENT_SIZE // 2
+    s32_stride = _INPUT_EVENT_SIZE // 4
+    monotonic_clock = device.fd in _monotonic_device_fds
+    size = os.readv(device.fd, [_raw_buffer])
+    note_read()
+    for i in range(size // _INPUT_EVENT_SIZE):
+        etype = u16[i * u16_stride + _TYPE_INDEX]
+        code = u16[i * u16_stride + _CODE_INDEX]
+        value = s32[i * s32_stride + _VALUE_INDEX]
+        if etype == ecodes.EV_KEY:
+            timestamp = None
+            if monotonic_clock:
+                timestamp = long_[i * long_stride] + long_[i * long_stride + 1] / 1000000.0
+            queue_pending_events(device.fd)
+            begin_keystroke(device.name, timestamp)
+            on_key_event(code, value, device.name, quiet, timestamp)
+            end_keystroke()
+        else:
+            send_raw_event(etype, code, value, device.fd)
+
+
+def loop(device_matches, device_watch, quiet, use_asyncio=False, raw_reader=False):
     devices = select_device(device_matches, True)
     try:
         for device in devices:
             device.grab()
+            use_monotonic_clock(device)
     except IOError:
         print("IOError when grabbing device. Maybe, another xkeysnail instance is running?")
         exit(1)
 
+    def read_device(device):
+        try:
+            if raw_reader:
+                read_raw_events(device, quiet)
+                return
+            monotonic_clock = device.fd in _monotonic_device_fds
+            note_read()
+            for event in device.read():
+                if event.type == ecodes.EV_KEY:
+                    timestamp = event.timestamp() if monotonic_clock else None
+                    queue_pending_events(device.fd)
+                    begin_keystroke(device.name, timestamp)
+                    on_event(event, device.name, quiet, timestamp)
+                    end_keystroke()
+                else:
+                    send_event(event, device.fd)
+        except BlockingIOError:
+            pass
+        except OSError:
+            remove_device(devices, device)
+            print("Device removed: " + str(device.name))
+
+    if is_profiler_enabled():
+        read_device = profiled(read_device)
+
+    for device in devices:
+        register(device, read_device)
+
     if device_watch:
         from inotify_simple import INotify, flags
         inotify = INotify()
         inotify.add_watch("/dev/input", flags.CREATE | flags.ATTRIB)
         print("Watching keyboard devices plug in")
-    device_filter = DeviceFilter(device_matches)
+        device_filter = DeviceFilter(device_matches)
+
+        def watch_devices(inotify):
+            new_devices = add_new_device(devices, device_filter, inotify, read_device)
+            if new_devices:
+                print("Okay, now enable remapping on the following new device(s):\n")
+                print_device_list(new_devices)
+
+        register(inotify, watch_devices)
 
     if quiet:
         print("No key event will be output since quiet option was specified.")
 
+    register(start_focus_tracking(), lambda display_fd: update_focus())
+
     try:
-        while True:
-            try:
-                waitables = devices[:]
-                if device_watch:
-                    waitables.append(inotify.fd)
-                r, w, x = select(waitables, [], [])
-
-                for waitable in r:
-                    if isinstance(waitable, InputDevice):
-                        for event in waitable.read():
-                            if event.type == ecodes.EV_KEY:
-                                on_event(event, waitable.name, quiet)
-                            else:
-                                send_event(event)
-                    else:
-                        new_devices = add_new_device(devices, device_filter, inotify)
-                        if new_devices:
-                            print("Okay, now enable remapping on the following new device(s):\n")
-                            print_device_list(new_devices)
-            except OSError:
-                if isinstance(waitable, InputDevice):
-                    remove_device(devices, waitable)
-                    print("Device removed: " + str(device.name))
-            except KeyboardInterrupt:
-                print("Received an interrupt, exiting.")
-                break
+        if use_asyncio:
+            run_asyncio_loop()
+        else:
+            run_select_loop()
+        print("Received an interrupt, exiting.")
     finally:
         for device in devices:
             try:
@@ -153,26 +258,117 @@ def loop(device_matches, device_watch, quiet):
             inotify.close()
 
 
-def add_new_device(devices, device_filter, inotify):
+def run_select_loop():
+    """Run the registered handlers and the timers until interrupted"""
+    import signal
+    # Signals are written to the pipe to wake up the selector, so that their
+    # callbacks run from the loop
+    wakeup_read_fd, wakeup_write_fd = os.pipe()
+    os.set_blocking(wakeup_read_fd, False)
+    os.set_blocking(wakeup_write_fd, False)
+    signal.set_wakeup_fd(wakeup_write_fd, warn_on_full_buffer=False)
+    register(wakeup_read_fd, read_signal_wakeup)
+    try:
+        while True:
+            try:
+                for selector_key, _ in _selector.select(get_timeout()):
+                    selector_key.data(selector_key.fileobj)
+                run_expired_timers()
+            except OSError:
+                pass
+            except KeyboardInterrupt:
+                return
+    finally:
+        signal.set_wakeup_fd(-1)
+        unregister(wakeup_read_fd)
+        os.close(wakeup_read_fd)
+        os.close(wakeup_write_fd)
+
+
+def read_signal_wakeup(fd):
+    try:
+        while os.read(fd, 512):
+            pass
+    except BlockingIOError:
+        pass
+    run_signal_handlers()
+
+
+def run_asyncio_loop():
+    """Run the registered handlers and the timers on an asyncio event loop
+    until interrupted"""
+    global _event_loop
+    import asyncio
+    import signal
+    _event_loop = asyncio.new_event_loop()
+    try:
+        for selector_key in _selector.get_map().values():
+            _event_loop.add_reader(selector_key.fileobj, run_handler, selector_key.data, selector_key.fileobj)
+        _event_loop.add_signal_handler(signal.SIGINT, _event_loop.stop)
+        for signum, callback in get_signal_handlers().items():
+            _event_loop.add_signal_handler(signum, callback)
+        run_signal_handlers()
+        arm_timer()
+        _event_loop.run_forever()
+    finally:
+        _event_loop.close()
+        _event_loop = None
+
+
+def run_handler(handler, fileobj):
+    handler(fileobj)
+    arm_timer()
+
+
+def run_timers():
+    global _timer_handle
+    _timer_handle = None
+    run_expired_timers()
+    arm_timer()
+
+
+def arm_timer():
+    """Make the asyncio event loop wake up for the next scheduler timer"""
+    global _timer_handle
+    timeout = get_timeout()
+    if timeout is None:
+        return
+    deadline = _event_loop.time() + timeout
+    if _timer_handle and _timer_handle.when() <= deadline:
+        return
+    if _timer_handle:
+        _timer_handle.cancel()
+    _timer_handle = _event_loop.call_at(deadline, run_timers)
+
+
+def add_new_device(devices, device_filter, inotify, handler=None):
     new_devices = []
     for event in inotify.read():
         new_device = InputDevice("/dev/input/" + event.name)
         if device_filter(new_device) and not in_device_list(new_device.fn, devices):
             try:
                 new_device.grab()
+                use_monotonic_clock(new_device)
             except IOError:
                 # Ignore errors on new devices
                 print("IOError when grabbing new device: " + str(new_device.name))
                 continue
             devices.append(new_device)
             new_devices.append(new_device)
+            if handler:
+                register(new_device, handler)
     return new_devices
 
 
 def remove_device(devices, device):
     devices.remove(device)
+    drop_pending_events(device.fd)
+    _monotonic_device_fds.discard(device.fd)
+    try:
+        unregister(device)
+    except KeyError:
+        pass
     try:
         device.ungrab()
     except OSError as e:
         pass
-
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import itertools
 from enum import Enum, unique, IntEnum
 
 __author__ = 'zh'
@@ -746,20 +747,7 @@ class Modifier(Enum):
 
     @classmethod
     def _get_modifier_map(cls):
-        return {
-            cls.L_CONTROL: {Key.LEFT_CTRL},
-            cls.R_CONTROL: {Key.RIGHT_CTRL},
-            cls.CONTROL: {Key.LEFT_CTRL, Key.RIGHT_CTRL},
-            cls.L_ALT: {Key.LEFT_ALT},
-            cls.R_ALT: {Key.RIGHT_ALT},
-            cls.ALT: {Key.LEFT_ALT, Key.RIGHT_ALT},
-            cls.L_SHIFT: {Key.LEFT_SHIFT},
-            cls.R_SHIFT: {Key.RIGHT_SHIFT},
-            cls.SHIFT: {Key.LEFT_SHIFT, Key.RIGHT_SHIFT},
-            cls.L_SUPER: {Key.LEFT_META},
-            cls.R_SUPER: {Key.RIGHT_META},
-            cls.SUPER: {Key.LEFT_META, Key.RIGHT_META}
-        }
+        return _MODIFIER_MAP
 
     def __str__(self):
         if self.value == self.L_CONTROL.value: return "LC"
@@ -807,54 +795,204 @@ class Modifier(Enum):
             return self.R_SUPER
 
     def get_keys(self):
-        return self._get_modifier_map()[self]
+        return _MODIFIER_MAP[self]
 
     def get_key(self):
-        return next(iter(self.get_keys()))
+        return _MODIFIER_KEY[self]
+
+    def get_mask(self):
+        return 1 << self.value
 
     @classmethod
     def get_all_keys(cls):
-        return {key for keys in cls._get_modifier_map().values() for key in keys}
+        return _ALL_MODIFIER_KEYS
+
+    @staticmethod
+    def is_modifier_key(key):
+        return _MODIFIER_KEY_BITS >> key & 1 == 1
 
     @staticmethod
     def from_key(key):
-        for modifier in Modifier:
-            if key in modifier.get_keys():
-                return modifier
+        if key < len(_MODIFIER_BY_KEY):
+            return _MODIFIER_BY_KEY[key]
+        return None
+
+    @staticmethod
+    def get_key_mask(key):
+        """Get mask bit of the (L/R-specified) modifier of key or 0 for a non-modifier key"""
+        if key < len(_MODIFIER_MASK_BY_KEY):
+            return _MODIFIER_MASK_BY_KEY[key]
+        return 0
+
+
+# Lookup tables for Modifier, built once at import
+_MODIFIER_MAP = {
+    Modifier.L_CONTROL: frozenset({Key.LEFT_CTRL}),
+    Modifier.R_CONTROL: frozenset({Key.RIGHT_CTRL}),
+    Modifier.CONTROL: frozenset({Key.LEFT_CTRL, Key.RIGHT_CTRL}),
+    Modifier.L_ALT: frozenset({Key.LEFT_ALT}),
+    Modifier.R_ALT: frozenset({Key.RIGHT_ALT}),
+    Modifier.ALT: frozenset({Key.LEFT_ALT, Key.RIGHT_ALT}),
+    Modifier.L_SHIFT: frozenset({Key.LEFT_SHIFT}),
+    Modifier.R_SHIFT: frozenset({Key.RIGHT_SHIFT}),
+    Modifier.SHIFT: frozenset({Key.LEFT_SHIFT, Key.RIGHT_SHIFT}),
+    Modifier.L_SUPER: frozenset({Key.LEFT_META}),
+    Modifier.R_SUPER: frozenset({Key.RIGHT_META}),
+    Modifier.SUPER: frozenset({Key.LEFT_META, Key.RIGHT_META})
+}
+_MODIFIER_KEY = {modifier: next(iter(keys)) for modifier, keys in _MODIFIER_MAP.items()}
+_ALL_MODIFIER_KEYS = frozenset(key for keys in _MODIFIER_MAP.values() for key in keys)
+_MODIFIER_KEY_BITS = sum(1 << key for key in _ALL_MODIFIER_KEYS)
+
+
+def _build_modifier_by_key():
+    # The first modifier containing a key (the L/R-specified one) wins
+    table = [None] * (max(_ALL_MODIFIER_KEYS) + 1)
+    for modifier in reversed(Modifier):
+        for key in modifier.get_keys():
+            table[key] = modifier
+    return tuple(table)
+
+
+_MODIFIER_BY_KEY = _build_modifier_by_key()
+_MODIFIER_MASK_BY_KEY = tuple(modifier.get_mask() if modifier else 0 for modifier in _MODIFIER_BY_KEY)
+
+
+def _build_generalized_modifier_masks():
+    # (mask of both sides, mask of the side-agnostic modifier) for each modifier
+    groups = [(modifier.to_left().get_mask() | modifier.to_right().get_mask(), modifier.get_mask())
+              for modifier in (Modifier.CONTROL, Modifier.ALT, Modifier.SHIFT, Modifier.SUPER)]
+    specified_mask = sum(side_masks for side_masks, _ in groups)
+    table = {}
+    for modifier_mask in range(specified_mask + 1):
+        if modifier_mask & ~specified_mask:
+            continue
+        options = []
+        for side_masks, agnostic_mask in groups:
+            specified = modifier_mask & side_masks
+            options.append((specified, agnostic_mask) if specified else (0,))
+        masks = [sum(masks) for masks in itertools.product(*options)]
+        # Most specific first (sort is stable, so the exact mask stays first)
+        masks.sort(key=lambda mask: bin(mask & ~specified_mask).count("1"))
+        table[modifier_mask] = tuple(masks)
+    return table
+
+
+_GENERALIZED_MODIFIER_MASKS = _build_generalized_modifier_masks()
+
+
+def generalize_modifier_mask(modifier_mask):
+    """Get the masks a set of pressed (L/R-specified) modifiers matches
 
+    E.g., LC-LShift yields LC-LShift, C-LShift, LC-Shift and C-Shift.
+    """
+    return _GENERALIZED_MODIFIER_MASKS[modifier_mask]
 
-class Combo:
 
-    def __init__(self, modifiers, key):
+# Decode tables indexed by the raw code/value of an input event
+_KEY_BY_CODE = tuple(Key._value2member_map_.get(code) for code in range(max(Key) + 1))
+_ACTION_BY_VALUE = tuple(Action)
+
+
+def decode_key(code):
+    """Equivalent of Key(code) without the Enum lookup machinery"""
+    if 0 <= code < len(_KEY_BY_CODE):
+        key = _KEY_BY_CODE[code]
+        if key is not None:
+            return key
+    # Unknown codes raise ValueError as Key(code) does
+    return Key(code)
+
+
+def decode_action(value):
+    """Equivalent of Action(value) without the Enum lookup machinery"""
+    if 0 <= value < len(_ACTION_BY_VALUE):
+        return _ACTION_BY_VALUE[value]
+    return Action(value)
+
+
+# Key codes fit in the low bits of an encoded combo (Key.KEY_CNT < 1 << 10)
+COMBO_KEY_BITS = 10
+
+
+def encode_combo(modifier_mask, key):
+    """Pack a mask of Modifier.get_mask() bits and a key code into an int"""
+    return modifier_mask << COMBO_KEY_BITS | key
+
+
+class Combo(object):
+    """Immutable key combination
+
+    Combos are interned: constructing a combo equal to an existing one returns
+    the existing instance, so equal combos share their modifier set and hash.
+    """
+
+    __slots__ = ('modifiers', 'key', 'modifier_mask', '_code')
+
+    # Interned combos keyed by their encoded form
+    _combos = {}
+
+    def __new__(cls, modifiers, key):
 
         if isinstance(modifiers, list):
             raise ValueError("modifiers should be a set instead of a list")
         elif modifiers is None:
-            modifiers = set()
+            modifiers = ()
         elif isinstance(modifiers, Modifier):
-            modifiers = {modifiers}
-        elif not isinstance(modifiers, set):
+            modifiers = (modifiers,)
+        elif not isinstance(modifiers, (set, frozenset)):
             raise ValueError("modifiers should be a set")
 
         if not isinstance(key, Key):
             raise ValueError("key should be a Key")
 
-        self.modifiers = modifiers
-        self.key = key
+        modifier_mask = 0
+        for modifier in modifiers:
+            modifier_mask |= modifier.get_mask()
+        return cls._intern(modifier_mask, key)
+
+    @classmethod
+    def _intern(cls, modifier_mask, key):
+        code = encode_combo(modifier_mask, key)
+        combo = cls._combos.get(code)
+        if combo is None:
+            combo = object.__new__(cls)
+            setattr_ = object.__setattr__
+            setattr_(combo, 'modifiers', frozenset(m for m in Modifier if m.get_mask() & modifier_mask))
+            setattr_(combo, 'key', key)
+            setattr_(combo, 'modifier_mask', modifier_mask)
+            setattr_(combo, '_code', code)
+            cls._combos[code] = combo
+        return combo
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Combo is immutable")
+
+    def __reduce__(self):
+        # Copies and unpickled combos are the interned instance
+        return (Combo, (self.modifiers, self.key))
 
     def __eq__(self, other):
         if isinstance(other, Combo):
-            return self.modifiers == other.modifiers and self.key == other.key
+            return self._code == other._code
         else:
             return NotImplemented
 
     def __hash__(self):
-        return hash((frozenset(self.modifiers), self.key))
+        return self._code
 
     def __str__(self):
-        return "-".join([str(mod) for mod in self.modifiers] + [self.key.name])
+        modifiers = [mod for mod in Modifier if mod in self.modifiers]
+        return "-".join([str(mod) for mod in modifiers] + [self.key.name])
+
+    def encode(self):
+        """Encode the combo into an int (see encode_combo)"""
+        return self._code
 
     def with_modifier(self, modifiers):
         if isinstance(modifiers, Modifier):
-            modifiers = {modifiers}
-        return Combo(self.modifiers | modifiers, self.key)
+            modifiers = (modifiers,)
+        modifier_mask = self.modifier_mask
+        for modifier in modifiers:
+            modifier_mask |= modifier.get_mask()
+        return Combo._intern(modifier_mask, self.key)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from time import monotonic
+from .scheduler import add_signal_handler
+
+# Values are recorded in microseconds keeping PRECISION_BITS significant bits,
+# i.e., 2 ** (PRECISION_BITS - 1) buckets per power of two (HDR histogram
+# style, within 1% of the recorded value)
+PRECISION_BITS = 8
+
+PERCENTILES = ((50.0, "p50"), (99.0, "p99"), (99.9, "p999"))
+
+
+class Histogram(object):
+    """Log-linear histogram of latencies in microseconds"""
+
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            # clocks of devices which do not switch to CLOCK_MONOTONIC
+            value = 0
+        shift = value.bit_length() - PRECISION_BITS
+        bucket = (value >> shift) << shift if shift > 0 else value
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Get the highest value equivalent to the bucket of the given percentile"""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                shift = bucket.bit_length() - PRECISION_BITS
+                return min(bucket + (1 << shift) - 1 if shift > 0 else bucket, self.max)
+        return self.max
+
+
+# Stages of a keystroke: (name, start stamp, end stamp) as indexes of _keystroke
+_KERNEL, _READ, _DECISION, _WRITE = 2, 3, 4, 5
+STAGES = (("kernel->read", _KERNEL, _READ),
+          ("read->decision", _READ, _DECISION),
+          ("decision->write", _DECISION, _WRITE),
+          ("read->write", _READ, _WRITE),
+          ("kernel->write", _KERNEL, _WRITE))
+
+_enabled = False
+# Histograms by (split, name, stage), e.g., ("device", "AT keyboard", "read->write")
+_histograms = {}
+# Time the events being handled were read at
+_read_time = None
+# The keystroke being handled: [device_name, keymap_name, kernel, read, decision, write]
+_keystroke = None
+
+
+def enable_latency_tracking():
+    """Record latencies of keystrokes, dumped on SIGUSR1 and at exit"""
+    global _enabled
+    import atexit
+    import signal
+    _enabled = True
+    add_signal_handler(signal.SIGUSR1, dump_latency_histograms)
+    atexit.register(dump_latency_histograms)
+
+
+def note_read():
+    global _read_time
+    if _enabled:
+        _read_time = monotonic()
+
+
+def begin_keystroke(device_name, kernel_time=None):
+    """Start timing an EV_KEY event with its kernel timestamp (monotonic clock)"""
+    global _keystroke
+    if _enabled:
+        _keystroke = [device_name, None, kernel_time, _read_time, None, None]
+
+
+def note_decision(keymap_name):
+    """The transform of the keystroke has been decided by keymap_name (None: pass through)"""
+    if _keystroke is not None and _keystroke[_DECISION] is None:
+        _keystroke[1] = keymap_name
+        _keystroke[_DECISION] = monotonic()
+
+
+def note_write():
+    if _keystroke is not None and _keystroke[_WRITE] is None:
+        _keystroke[_WRITE] = monotonic()
+
+
+def end_keystroke():
+    """Record the stages of the keystroke
+
+    Output sent later (e.g., after sleep() or by a timer) is not counted.
+    """
+    global _keystroke
+    keystroke = _keystroke
+    if keystroke is None:
+        return
+    _keystroke = None
+    keymap_name = keystroke[1] if keystroke[_DECISION] is not None else "(no keymap)"
+    splits = (("device", keystroke[0]), ("keymap", keymap_name or "(pass through)"))
+    for stage, start, end in STAGES:
+        if keystroke[start] is None or keystroke[end] is None:
+            continue
+        latency = (keystroke[end] - keystroke[start]) * 1000000
+        for split, name in splits:
+            key = (split, name, stage)
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram()
+            histogram.record(latency)
+
+
+def dump_latency_histograms():
+    print("Keystroke latencies (microseconds):")
+    print("{:<40} {:<16} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        "", "stage", "count", *[label for _, label in PERCENTILES], "max"))
+    stage_order = dict((stage, i) for i, (stage, _, _) in enumerate(STAGES))
+    for (split, name, stage), histogram in sorted(_histograms.items(),
+                                                  key=lambda item: (item[0][:2], stage_order[item[0][2]])):
+        print("{:<40} {:<16} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "{} '{}'".format(split, name)[:40], stage, histogram.count,
+            *[histogram.percentile(percent) for percent, _ in PERCENTILES], histogram.max))
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
+import struct
+import weakref
 from evdev import ecodes
 from evdev.uinput import UInput
-from .key import Action, Combo, Modifier
+from .key import Action, Combo, Key, Modifier
+from .latency import note_write
 
 __author__ = 'zh'
 
@@ -30,16 +34,23 @@ _keyboard_codes.update(mouse_btns)
 _uinput = UInput(events={ecodes.EV_KEY: _keyboard_codes,
                          ecodes.EV_REL: set([0,1,6,8,9]),
                          })
+# Processes launched by keymaps must not inherit uinput
+os.set_inheritable(_uinput.fd, False)
 
 _pressed_modifier_keys = set()
+# Modifier.get_key_mask() bits of _pressed_modifier_keys
+_pressed_modifier_key_mask = 0
 _pressed_keys = set()
 
 def update_modifier_key_pressed(key, action):
-    if key in Modifier.get_all_keys():
+    global _pressed_modifier_key_mask
+    if Modifier.is_modifier_key(key):
         if action.is_pressed():
             _pressed_modifier_keys.add(key)
+            _pressed_modifier_key_mask |= Modifier.get_key_mask(key)
         else:
             _pressed_modifier_keys.discard(key)
+            _pressed_modifier_key_mask &= ~Modifier.get_key_mask(key)
 
 def update_pressed_keys(key, action):
     if action.is_pressed():
@@ -50,54 +61,241 @@ def update_pressed_keys(key, action):
 def is_pressed(key):
     return key in _pressed_keys
 
-def send_sync():
-    _uinput.syn()
+# Events are encoded into _output_buffer and written to uinput with a single
+# write() per logical step (a key action, a combo, ...) by flush()
 
+# struct input_event {struct timeval time; __u16 type; __u16 code; __s32 value;}
+# (uinput ignores the time, so it is left zero)
+_input_event = struct.Struct("llHHi")
+_output_buffer = bytearray()
 
-def send_event(event):
-    _uinput.write_event(event)
-    send_sync()
+_SYN_REPORT_EVENT = _input_event.pack(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
 
+# Whether send_combo() reports every key transition in its own frame
+# ("key") or groups the presses and the releases into one frame each ("combo")
+_combo_sync = "key"
 
-def send_key_action(key, action):
+
+def define_combo_sync(mode="key"):
+    """Defines how the key transitions of a combo are grouped into frames
+
+    "key" sends a SYN_REPORT after each transition (safest), "combo" sends
+    one frame for the presses and one for the releases.
+
+    Example:
+
+    define_combo_sync("combo")
+    """
+    global _combo_sync
+    if mode not in ("key", "combo"):
+        raise ValueError('mode must be "key" or "combo"')
+    _combo_sync = mode
+    _emission_plans.clear()
+    for macro in _macros:
+        macro._plans.clear()
+
+
+def queue_event(etype, code, value):
+    _output_buffer.extend(_input_event.pack(0, 0, etype, code, value))
+
+
+def queue_sync():
+    _output_buffer.extend(_SYN_REPORT_EVENT)
+
+
+def queue_key_action(key, action):
     update_modifier_key_pressed(key, action)
     update_pressed_keys(key, action)
-    _uinput.write(ecodes.EV_KEY, key, action)
+    queue_event(ecodes.EV_KEY, key, action)
+
+
+def flush():
+    if _output_buffer:
+        try:
+            os.write(_uinput.fd, _output_buffer)
+        finally:
+            # a failed write must not be sent again ahead of the next output
+            del _output_buffer[:]
+        note_write()
+
+
+def send_sync():
+    queue_sync()
+    flush()
+
+
+# Passed-through events of each source (e.g., a device fd), held until the
+# SYN_REPORT of the source so that its frames are written as they were read
+_pending_frames = {}
+# Sources which lost events, whose events are ignored until their next SYN_REPORT
+_dropping_sources = set()
+
+
+def send_event(event, source=None):
+    send_raw_event(event.type, event.code, event.value, source)
+
+
+def send_raw_event(etype, code, value, source=None):
+    """Pass through an event read from source"""
+    if source in _dropping_sources:
+        # the rest of the frame after SYN_DROPPED is incomplete as well
+        if etype == ecodes.EV_SYN and code == ecodes.SYN_REPORT:
+            _dropping_sources.discard(source)
+        return
+    if etype == ecodes.EV_SYN and code == ecodes.SYN_REPORT:
+        frame = _pending_frames.pop(source, None)
+        if frame:
+            _output_buffer.extend(frame)
+        if _output_buffer:
+            send_sync()
+    elif etype == ecodes.EV_SYN and code == ecodes.SYN_DROPPED:
+        # the source lost events, so its current frame is incomplete
+        _pending_frames.pop(source, None)
+        _dropping_sources.add(source)
+    else:
+        frame = _pending_frames.get(source)
+        if frame is None:
+            frame = _pending_frames[source] = bytearray()
+        frame.extend(_input_event.pack(0, 0, etype, code, value))
+
+
+def queue_pending_events(source):
+    """Queue the passed-through events of source ahead of the next output,
+    e.g., before handling a key event of the same frame"""
+    frame = _pending_frames.pop(source, None)
+    if frame:
+        _output_buffer.extend(frame)
+
+
+def drop_pending_events(source):
+    _pending_frames.pop(source, None)
+    _dropping_sources.discard(source)
+
+
+def send_key_action(key, action):
+    queue_key_action(key, action)
     send_sync()
 
 
-def send_combo(combo):
+# Emission plans of send_combo() keyed by (_pressed_modifier_key_mask, combo)
+_emission_plans = {}
+_emission_plans_size = 4096
 
-    released_modifiers_keys = []
 
-    extra_modifier_keys = _pressed_modifier_keys.copy()
-    missing_modifiers = combo.modifiers.copy()
-    for pressed_key in _pressed_modifier_keys:
+def get_emission_plan(modifier_key_mask, combo):
+    """Get the key transitions sending combo while the modifier keys of
+    modifier_key_mask are pressed, along with their encoded events"""
+    plan_key = (modifier_key_mask, combo)
+    plan = _emission_plans.get(plan_key)
+    if plan is None:
+        if len(_emission_plans) >= _emission_plans_size:
+            _emission_plans.clear()
+        plan = _emission_plans[plan_key] = make_emission_plan(modifier_key_mask, combo)
+    return plan
+
+
+def make_emission_plan(modifier_key_mask, combo):
+    per_key = _combo_sync == "key"
+    transitions = []
+    data = bytearray()
+
+    def add(key, action, sync):
+        transitions.append((key, action))
+        data.extend(_input_event.pack(0, 0, ecodes.EV_KEY, key, action))
+        if sync:
+            data.extend(_SYN_REPORT_EVENT)
+
+    pressed_modifier_keys = [modifier.get_key() for modifier in Modifier
+                             if modifier.get_mask() & modifier_key_mask]
+    extra_modifier_keys = list(pressed_modifier_keys)
+    missing_modifiers = [modifier for modifier in Modifier if modifier in combo.modifiers]
+    for pressed_key in pressed_modifier_keys:
         for modifier in combo.modifiers:
             if pressed_key in modifier.get_keys():
                 extra_modifier_keys.remove(pressed_key)
-                missing_modifiers.remove(modifier)
+                if modifier in missing_modifiers:
+                    missing_modifiers.remove(modifier)
+                break
 
     for modifier_key in extra_modifier_keys:
-        send_key_action(modifier_key, Action.RELEASE)
-        released_modifiers_keys.append(modifier_key)
+        add(modifier_key, Action.RELEASE, per_key)
+
+    missing_modifier_keys = [modifier.get_key() for modifier in missing_modifiers]
+    for modifier_key in missing_modifier_keys:
+        add(modifier_key, Action.PRESS, per_key)
 
-    pressed_modifier_keys = []
-    for modifier in missing_modifiers:
-        modifier_key = modifier.get_key()
-        send_key_action(modifier_key, Action.PRESS)
-        pressed_modifier_keys.append(modifier_key)
+    add(combo.key, Action.PRESS, True)
+    add(combo.key, Action.RELEASE, per_key)
 
-    send_key_action(combo.key, Action.PRESS)
+    for modifier_key in reversed(missing_modifier_keys):
+        add(modifier_key, Action.RELEASE, per_key)
 
-    send_key_action(combo.key, Action.RELEASE)
+    for modifier_key in reversed(extra_modifier_keys):
+        add(modifier_key, Action.PRESS, per_key)
 
-    for modifier in reversed(pressed_modifier_keys):
-        send_key_action(modifier, Action.RELEASE)
+    if not per_key:
+        data.extend(_SYN_REPORT_EVENT)
+    return tuple(transitions), bytes(data)
 
-    for modifier in reversed(released_modifiers_keys):
-        send_key_action(modifier, Action.PRESS)
+
+def send_combo(combo):
+    transitions, data = get_emission_plan(_pressed_modifier_key_mask, combo)
+    for key, action in transitions:
+        update_modifier_key_pressed(key, action)
+        update_pressed_keys(key, action)
+    _output_buffer.extend(data)
+    flush()
 
 
 def send_key(key):
     send_combo(Combo(None, key))
+
+
+# Macros whose plans depend on _combo_sync
+_macros = weakref.WeakSet()
+
+
+class Macro(object):
+    """Sequence of keys and combos sent with a single write
+
+    The events are encoded once per mask of modifier keys pressed when the
+    macro starts.
+    """
+
+    __slots__ = ('combos', '_plans', '__weakref__')
+
+    def __init__(self, commands):
+        self.combos = tuple(Combo(None, command) if isinstance(command, Key) else command
+                            for command in commands)
+        self._plans = {}
+        _macros.add(self)
+
+    def get_plan(self, modifier_key_mask):
+        plan = self._plans.get(modifier_key_mask)
+        if plan is None:
+            plan = self._plans[modifier_key_mask] = self.make_plan(modifier_key_mask)
+        return plan
+
+    def make_plan(self, modifier_key_mask):
+        transitions = []
+        data = bytearray()
+        for combo in self.combos:
+            combo_transitions, combo_data = make_emission_plan(modifier_key_mask, combo)
+            transitions.extend(combo_transitions)
+            data.extend(combo_data)
+            # A combo restores the modifiers unless its key is a modifier key
+            for key, action in combo_transitions:
+                if action.is_pressed():
+                    modifier_key_mask |= Modifier.get_key_mask(key)
+                else:
+                    modifier_key_mask &= ~Modifier.get_key_mask(key)
+        return tuple(transitions), bytes(data)
+
+
+def send_macro(macro):
+    transitions, data = macro.get_plan(_pressed_modifier_key_mask)
+    for key, action in transitions:
+        update_modifier_key_pressed(key, action)
+        update_pressed_keys(key, action)
+    _output_buffer.extend(data)
+    flush()
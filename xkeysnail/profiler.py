@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+from .scheduler import add_signal_handler
+
+# File the pstats of a profiling run are written to (None: profiling is disabled)
+_profile_path = None
+# Profiler of the running profiling run
+_profiler = None
+
+
+def enable_profiler(path):
+    """Profile the handling of input events and write pstats to path
+
+    Profiling starts at once. SIGUSR2 writes the stats and stops it, and
+    the next SIGUSR2 starts a new run. The stats of a running run are also
+    written at exit. The stats can be read with `python -m pstats path`.
+    """
+    global _profile_path
+    import atexit
+    import signal
+    _profile_path = path
+    add_signal_handler(signal.SIGUSR2, toggle_profiling)
+    atexit.register(stop_profiling)
+    start_profiling()
+
+
+def is_profiler_enabled():
+    return _profile_path is not None
+
+
+def start_profiling():
+    global _profiler
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+        print("Profiling started")
+
+
+def stop_profiling():
+    global _profiler
+    if _profiler is not None:
+        profiler = _profiler
+        _profiler = None
+        profiler.dump_stats(_profile_path)
+        print("Profiling stopped, wrote stats to " + _profile_path)
+
+
+def toggle_profiling():
+    if _profiler is None:
+        start_profiling()
+    else:
+        stop_profiling()
+
+
+def profiled(func):
+    """Wrap func to be profiled while a profiling run is going on"""
+    def wrapper(*args):
+        profiler = _profiler
+        if profiler is None:
+            return func(*args)
+        return profiler.runcall(func, *args)
+    return wrapper
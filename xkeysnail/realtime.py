@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import gc
+import os
+
+# SCHED_FIFO priority of the event loop (above normal threads, below kernel IRQ threads)
+SCHED_PRIORITY = 10
+
+# mlockall() flags from <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# GC thresholds for the steady state: the loop allocates only a few objects
+# per keystroke, so young collections can be rare
+GC_THRESHOLDS = (50000, 20, 100)
+
+
+def set_fifo_scheduler(priority=SCHED_PRIORITY):
+    # Processes started by launch() go back to the normal scheduler
+    os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK, os.sched_param(priority))
+    return "priority {}, reset on fork".format(priority)
+
+
+def lock_memory():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return "current and future pages"
+
+
+def pin_cpu(cpu):
+    os.sched_setaffinity(0, {cpu})
+    return "CPU {}".format(cpu)
+
+
+def freeze_gc(thresholds=GC_THRESHOLDS):
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(*thresholds)
+    return "{} objects frozen, thresholds {}".format(gc.get_freeze_count(), thresholds)
+
+
+def enter_realtime_mode(cpu=None):
+    """Reduce the latency of the event loop on the calling thread
+
+    Should be called after the configuration is loaded, so its objects are
+    frozen out of the garbage collector. Each step may fail (e.g., without
+    CAP_SYS_NICE or with a low RLIMIT_MEMLOCK) independently of the others.
+    Returns a list of (step, succeeded, detail).
+    """
+    steps = [("SCHED_FIFO", set_fifo_scheduler, ()),
+             ("mlockall", lock_memory, ())]
+    if cpu is not None:
+        steps.append(("CPU pinning", pin_cpu, (cpu,)))
+    steps.append(("GC freeze", freeze_gc, ()))
+    results = []
+    for name, step, args in steps:
+        try:
+            results.append((name, True, step(*args)))
+        except (OSError, ValueError) as e:
+            results.append((name, False, str(e)))
+    return results
+
+
+def print_realtime_report(results):
+    for name, succeeded, detail in results:
+        print("Realtime: {:<12} {} ({})".format(name, "ok" if succeeded else "FAILED", detail))
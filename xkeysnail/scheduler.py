@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import signal
+from itertools import count
+from time import monotonic
+
+# Timers run by the event loop, a heap of [deadline, sequence, callback]
+# (the sequence keeps timers with the same deadline in scheduling order)
+_timers = []
+_sequence = count()
+
+
+def call_later(delay, callback):
+    """Run callback from the event loop after delay seconds
+
+    Returns a timer which can be passed to cancel().
+    """
+    return call_at(monotonic() + delay, callback)
+
+
+def call_at(deadline, callback):
+    """Run callback from the event loop once the monotonic clock reaches deadline
+
+    Returns a timer which can be passed to cancel().
+    """
+    timer = [deadline, next(_sequence), callback]
+    heapq.heappush(_timers, timer)
+    return timer
+
+
+def cancel(timer):
+    """Cancel a timer returned by call_later() (no-op once it has run)"""
+    timer[2] = None
+
+
+def get_timeout():
+    """Get seconds until the next timer expires, or None if there is none"""
+    while _timers and _timers[0][2] is None:
+        heapq.heappop(_timers)
+    if not _timers:
+        return None
+    return max(0.0, _timers[0][0] - monotonic())
+
+
+def run_expired_timers():
+    """Run callbacks of the expired timers"""
+    now = monotonic()
+    while _timers and _timers[0][0] <= now:
+        timer = heapq.heappop(_timers)
+        callback = timer[2]
+        if callback is not None:
+            timer[2] = None
+            callback()
+
+
+# Callbacks of signals keyed by signal number, and the signals received but
+# not handled yet. The callbacks run from the event loop, not from Python's
+# signal handlers, which may interrupt any code (e.g., a print()).
+_signal_handlers = {}
+_pending_signals = []
+
+
+def add_signal_handler(signum, callback):
+    """Run callback from the event loop when signum is received"""
+    _signal_handlers[signum] = callback
+    signal.signal(signum, _queue_signal)
+
+
+def get_signal_handlers():
+    return dict(_signal_handlers)
+
+
+def _queue_signal(signum, frame):
+    _pending_signals.append(signum)
+
+
+def run_signal_handlers():
+    """Run callbacks of the signals received so far"""
+    while _pending_signals:
+        callback = _signal_handlers.get(_pending_signals.pop(0))
+        if callback is not None:
+            callback()
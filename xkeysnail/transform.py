@@ -1,21 +1,129 @@
 # -*- coding: utf-8 -*-
 
-import itertools
+import os
 import re
+import signal
+from collections import OrderedDict, deque
 from time import monotonic
 from inspect import signature
-from .key import Action, Combo, Key, Modifier
-from .output import send_combo, send_key_action, send_key, is_pressed
+from .key import Action, Combo, Key, Modifier, decode_action, decode_key, encode_combo, \
+    generalize_modifier_mask
+from .scheduler import call_at, call_later, cancel as cancel_timer
+from .latency import note_decision
+from .output import send_combo, send_key_action, send_key, send_macro, is_pressed, define_combo_sync, Macro
 
 __author__ = 'zh'
 
 # ============================================================ #
 
 import Xlib.display
+from Xlib import X
 
+_display = Xlib.display.Display()
+_NET_ACTIVE_WINDOW = _display.intern_atom('_NET_ACTIVE_WINDOW')
 
-def get_active_window_wm_class(display=Xlib.display.Display()):
-    """Get active window's WM_CLASS"""
+# WM_CLASS of the focused window, kept up to date by update_focus() once
+# start_focus_tracking() is called (None means focus is not tracked)
+_focused_wm_class = None
+
+# Window holding the input focus, whose FocusOut triggers a re-query of the focus
+_focus_window = None
+
+# Resolved WM_CLASS pairs keyed by window id, evicted on DestroyNotify
+_window_class_cache = OrderedDict()
+_window_class_cache_size = 256
+
+
+def start_focus_tracking():
+    """Subscribe to focus changes
+
+    _NET_ACTIVE_WINDOW changes on the root window give the window activated
+    by an EWMH window manager. Focus changes that do not go through it (e.g.,
+    non-EWMH window managers or XSetInputFocus() by launchers) are caught by
+    FocusOut of the focused window, which is watched as focus moves.
+
+    Returns the file descriptor of the X connection, which should be watched
+    by the event loop and handed to update_focus() when it becomes readable.
+    """
+    global _focused_wm_class
+    root = _display.screen().root
+    root.change_attributes(event_mask=X.PropertyChangeMask | X.FocusChangeMask)
+    _focused_wm_class = query_focused_window_wm_class()
+    return _display.fileno()
+
+
+def update_focus():
+    """Process pending X events and refresh the focused WM_CLASS if needed"""
+    global _focused_wm_class
+    global _focus_window
+    # The last focus change seen: the active window or the input focus
+    focus_changed = None
+    while True:
+        while _display.pending_events():
+            event = _display.next_event()
+            if event.type == X.PropertyNotify and event.atom == _NET_ACTIVE_WINDOW:
+                focus_changed = _NET_ACTIVE_WINDOW
+            elif event.type in (X.FocusIn, X.FocusOut):
+                focus_changed = X.FocusIn
+            elif event.type == X.DestroyNotify:
+                _window_class_cache.pop(event.window.id, None)
+                if _focus_window is not None and event.window.id == _focus_window.id:
+                    _focus_window = None
+                    focus_changed = X.FocusIn
+        if focus_changed is None:
+            break
+        # Querying the focus may queue further events, so loop until drained
+        if focus_changed == _NET_ACTIVE_WINDOW:
+            wm_class = query_net_active_window_wm_class()
+            _focused_wm_class = wm_class if wm_class is not None else query_focused_window_wm_class()
+        else:
+            _focused_wm_class = query_focused_window_wm_class()
+        focus_changed = None
+
+
+def query_net_active_window_wm_class():
+    """Get WM_CLASS of the window in the _NET_ACTIVE_WINDOW property of the
+    root window (None if no window is active)"""
+    try:
+        prop = _display.screen().root.get_full_property(_NET_ACTIVE_WINDOW, X.AnyPropertyType)
+    except Exception:
+        return None
+    if not prop or not prop.value or not prop.value[0]:
+        return None
+    pair = get_class_name(_display.create_resource_object('window', prop.value[0]))
+    return str(pair[1]) if pair else ""
+
+
+def query_focused_window_wm_class():
+    """Get WM_CLASS of the window holding the input focus, and watch that
+    window to be notified when the focus leaves it"""
+    global _focus_window
+    window = _display.get_input_focus().focus
+    window_id = getattr(window, "id", None)
+    # Resolve first, as caching the class selects StructureNotifyMask only
+    pair = get_class_name(window)
+    if _focus_window is None or _focus_window.id != window_id:
+        if _focus_window is not None:
+            _focus_window.change_attributes(event_mask=X.StructureNotifyMask, onerror=_ignore_x_error)
+        _focus_window = None
+        if window_id is not None:
+            window.change_attributes(event_mask=X.StructureNotifyMask | X.FocusChangeMask,
+                                     onerror=_ignore_x_error)
+            _focus_window = window
+    return str(pair[1]) if pair else ""
+
+
+def get_active_window_wm_class(display=None):
+    """Get active window's WM_CLASS (without X traffic when focus is tracked)"""
+    if display is None:
+        if _focused_wm_class is not None:
+            return _focused_wm_class
+        display = _display
+    return query_active_window_wm_class(display)
+
+
+def query_active_window_wm_class(display):
+    """Get active window's WM_CLASS from the X server"""
     current_window = display.get_input_focus().focus
     pair = get_class_name(current_window)
     if pair:
@@ -26,7 +134,30 @@ def get_active_window_wm_class(display=Xlib.display.Display()):
 
 
 def get_class_name(window):
-    """Get window's class name (recursively checks parents)"""
+    """Get window's class name (recursively checks parents, cached per window)"""
+    window_id = getattr(window, "id", None)
+    if window_id is None:
+        # No focus (X.NONE or X.PointerRoot)
+        return None
+    if window_id in _window_class_cache:
+        _window_class_cache.move_to_end(window_id)
+        return _window_class_cache[window_id]
+    wmclass = resolve_class_name(window)
+    if wmclass:
+        # Get notified of the window's destruction to evict the entry
+        window.change_attributes(event_mask=X.StructureNotifyMask, onerror=_ignore_x_error)
+        _window_class_cache[window_id] = wmclass
+        if len(_window_class_cache) > _window_class_cache_size:
+            _window_class_cache.popitem(last=False)
+    return wmclass
+
+
+def _ignore_x_error(*args):
+    pass
+
+
+def resolve_class_name(window):
+    """Get window's class name from the X server"""
     try:
         wmname = window.get_wm_name()
         wmclass = window.get_wm_class()
@@ -45,13 +176,18 @@ def get_class_name(window):
 
 
 _pressed_modifier_keys = set()
+# Modifier.get_mask() bits of _pressed_modifier_keys
+_pressed_modifier_mask = 0
 
 
 def update_pressed_modifier_keys(key, action):
+    global _pressed_modifier_mask
     if action.is_pressed():
         _pressed_modifier_keys.add(key)
+        _pressed_modifier_mask |= Modifier.get_key_mask(key)
     else:
         _pressed_modifier_keys.discard(key)
+        _pressed_modifier_mask &= ~Modifier.get_key_mask(key)
 
 
 def get_pressed_modifiers():
@@ -112,19 +248,58 @@ def with_or_set_mark(combo):
 # ============================================================ #
 
 
+# Processes started by launch(), reaped on the next launch
+_launched_pids = set()
+
+
 def launch(command):
-    """Launch command"""
+    """Launch command
+
+    posix_spawn() is used when available, which avoids forking the whole
+    process. The children do not inherit the grabbed devices nor uinput.
+    """
+    if isinstance(command, str):
+        command = [command]
+
     def launcher():
-        from subprocess import Popen
-        Popen(command)
+        reap_launched_processes()
+        if hasattr(os, "posix_spawnp"):
+            # Reset the signals Python ignores, as Popen(restore_signals=True) does
+            _launched_pids.add(os.posix_spawnp(command[0], command, os.environ,
+                                               setsigdef=(signal.SIGPIPE, signal.SIGXFSZ)))
+        else:
+            from subprocess import Popen
+            Popen(command, close_fds=True)
     return launcher
 
 
+def reap_launched_processes():
+    for pid in list(_launched_pids):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                continue
+        except ChildProcessError:
+            pass
+        _launched_pids.discard(pid)
+
+
+class Delay(object):
+    """Command that delays the commands following it"""
+
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
 def sleep(sec):
-    """Sleep sec in commands"""
+    """Sleep sec in commands
+
+    The rest of the commands is run by a timer, so other input keeps being
+    processed in the meantime.
+    """
     def sleeper():
-        import time
-        time.sleep(sec)
+        return Delay(sec)
     return sleeper
 
 # ============================================================ #
@@ -186,6 +361,10 @@ def create_modifiers_from_strings(modifier_strs):
 _toplevel_keymaps = []
 _mode_maps = None
 
+# (merged mappings, keymap names) of the active keymaps keyed by WM_CLASS
+_active_keymaps_cache = OrderedDict()
+_active_keymaps_cache_size = 64
+
 escape_next_key = {}
 pass_through_key = {}
 
@@ -193,58 +372,88 @@ pass_through_key = {}
 def define_keymap(condition, mappings, name="Anonymous keymap"):
     global _toplevel_keymaps
 
-    # Expand not L/R-specified modifiers
-    # Suppose a nesting is not so deep
-    # {K("C-a"): Key.A,
-    #  K("C-b"): {
-    #      K("LC-c"): Key.B,
-    #      K("C-d"): Key.C}}
-    # ->
-    # {K("LC-a"): Key.A, K("RC-a"): Key.A,
-    #  K("LC-b"): {
-    #      K("LC-c"): Key.B,
-    #      K("LC-d"): Key.C,
-    #      K("RC-d"): Key.C},
-    #  K("RC-b"): {
-    #      K("LC-c"): Key.B,
-    #      K("LC-d"): Key.C,
-    #      K("RC-d"): Key.C}}
-    def expand(target):
-        if isinstance(target, dict):
-            expanded_mappings = {}
-            keys_for_deletion = []
-            for k, v in target.items():
-                # Expand children
-                expand(v)
-
-                if isinstance(k, Combo):
-                    expanded_modifiers = []
-                    for modifier in k.modifiers:
-                        if not modifier.is_specified():
-                            expanded_modifiers.append([modifier.to_left(), modifier.to_right()])
-                        else:
-                            expanded_modifiers.append([modifier])
-
-                    # Create a Cartesian product of expanded modifiers
-                    expanded_modifier_lists = itertools.product(*expanded_modifiers)
-                    # Create expanded mappings
-                    for modifiers in expanded_modifier_lists:
-                        expanded_mappings[Combo(set(modifiers), k.key)] = v
-                    keys_for_deletion.append(k)
-
-
-            # Delete original mappings whose key was expanded into expanded_mappings
-            for key in keys_for_deletion:
-                del target[key]
-            # Merge expanded mappings into original mappings
-            target.update(expanded_mappings)
-
-    expand(mappings)
-
-    _toplevel_keymaps.append((condition, mappings, name))
+    # Modifiers without L/R specified (e.g., K("C-a")) are not expanded here,
+    # but matched against both sides when looking up a key (see lookup_keymap)
+    _toplevel_keymaps.append((condition, compile_keymap(mappings), name))
+    _active_keymaps_cache.clear()
     return mappings
 
 
+class CompiledKeymap(dict):
+    """Keymap keyed by encoded combos (see Combo.encode)
+
+    Values are (priority, command) pairs. Priorities only differ in the
+    merged top-level keymap, where they give precedence to earlier keymaps.
+    """
+
+
+def compile_keymap(mappings):
+    """Compile a keymap and its sub-keymaps into CompiledKeymaps"""
+    compiled = CompiledKeymap()
+    for combo, command in mappings.items():
+        if isinstance(combo, Combo):
+            compiled[combo.encode()] = (0, compile_command(command))
+    return compiled
+
+
+def compile_command(command):
+    if command is escape_next_key or command is pass_through_key:
+        return command
+    if isinstance(command, dict):
+        return compile_keymap(command)
+    if isinstance(command, list):
+        if command and all(isinstance(c, (Key, Combo)) for c in command):
+            # Plain key sequences are pre-encoded and sent with a single write
+            return Macro(command)
+        return [compile_command(c) for c in command]
+    return command
+
+
+def get_active_keymaps(wm_class):
+    """Get the keymaps active for wm_class merged into one mapping, and their names
+
+    The result is cached per WM_CLASS until a keymap is defined again.
+    """
+    try:
+        _active_keymaps_cache.move_to_end(wm_class)
+        return _active_keymaps_cache[wm_class]
+    except KeyError:
+        pass
+    merged_mappings = CompiledKeymap()
+    keymap_names = []
+    for condition, mappings, name in _toplevel_keymaps:
+        if (callable(condition) and condition(wm_class)) \
+           or (hasattr(condition, "search") and condition.search(wm_class)) \
+           or condition is None:
+            # Earlier keymaps take precedence over later ones
+            priority = len(keymap_names)
+            for code, (_, command) in mappings.items():
+                merged_mappings.setdefault(code, (priority, command))
+            keymap_names.append(name)
+    active_keymaps = (merged_mappings, keymap_names)
+    _active_keymaps_cache[wm_class] = active_keymaps
+    if len(_active_keymaps_cache) > _active_keymaps_cache_size:
+        _active_keymaps_cache.popitem(last=False)
+    return active_keymaps
+
+
+def lookup_keymap(mappings, modifier_masks, key):
+    """Find the (priority, command) entry of a compiled keymap for key
+
+    modifier_masks lists the pressed modifiers from the most to the least
+    L/R-specific form (see generalize_modifier_mask). The entry with the
+    highest priority wins, the most specific one among equal priorities.
+    """
+    found = None
+    for modifier_mask in modifier_masks:
+        entry = mappings.get(encode_combo(modifier_mask, key))
+        if entry is not None and (found is None or entry[0] < found[0]):
+            if entry[0] == 0:
+                return entry
+            found = entry
+    return found
+
+
 # ============================================================
 # Key handler
 # ============================================================
@@ -269,6 +478,7 @@ _simultaneous_single_key_mappings = {}
 # or REPEAT
 _last_key = None
 _last_simul_key = None
+_simultaneous_flush_timer = None
 
 # last key time record time when execute multi press
 _last_key_time = monotonic()
@@ -277,6 +487,16 @@ def define_timeout(milliseconds=1000):
     global _timeout
     _timeout = milliseconds
 
+# a multipurpose key held this long sends its modifier (None: wait for another key)
+_multipurpose_hold_threshold = None
+def define_multipurpose_hold_threshold(milliseconds=None):
+    global _multipurpose_hold_threshold
+    _multipurpose_hold_threshold = milliseconds
+
+# timers committing held multipurpose keys and the keys already committed
+_multipurpose_hold_timers = {}
+_multipurpose_held_keys = set()
+
 _simultaneous_key_timeout = 200
 def define_simultaneous_key_timeout(milliseconds=200):
     global _simultaneous_key_timeout
@@ -347,6 +567,19 @@ def define_simultaneous_keymap(simul_key_mappings, name):
 
 
 
+def normalize_condition(condition):
+    """Turn a compiled regexp or a function of (wm_class) or (wm_class,
+    device_name) into a function of (wm_class, device_name)"""
+    if hasattr(condition, 'search'):
+        search = condition.search
+        return lambda wm_class, device_name: search(wm_class)
+    if not callable(condition):
+        raise ValueError('condition must be a function or compiled regexp')
+    if len(signature(condition).parameters) == 2:
+        return condition
+    return lambda wm_class, device_name: condition(wm_class)
+
+
 def define_modmap(mod_remappings):
     """Defines modmap (keycode translation)
 
@@ -369,10 +602,7 @@ def define_conditional_modmap(condition, mod_remappings):
         Key.CAPSLOCK: Key.LEFT_CTRL
     })
     """
-    if hasattr(condition, 'search'):
-        condition = condition.search
-    if not callable(condition):
-        raise ValueError('condition must be a function or compiled regexp')
+    condition = normalize_condition(condition)
     _conditional_mod_map.append((condition, mod_remappings))
 
 
@@ -405,16 +635,13 @@ def define_conditional_multipurpose_modmap(condition, multipurpose_remappings):
         {Key.CAPSLOCK: [Key.ESC, Key.LEFT_CTRL]
     })
     """
-    if hasattr(condition, 'search'):
-        condition = condition.search
-    if not callable(condition):
-        raise ValueError('condition must be a function or compiled regexp')
+    condition = normalize_condition(condition)
     for key, value in multipurpose_remappings.items():
         value.append(Action.RELEASE)
     _conditional_multipurpose_map.append((condition, multipurpose_remappings))
 
 
-def multipurpose_handler(multipurpose_map, key, action):
+def multipurpose_handler(multipurpose_map, key, action, context=None):
 
     def maybe_press_modifiers(multipurpose_map):
         """Search the multipurpose map for keys that are pressed. If found and
@@ -422,7 +649,7 @@ def multipurpose_handler(multipurpose_map, key, action):
         # {Key.ENTER: [Key.ENTER, Key.RIGHT_CTRL, Action.RELEASE]}
         for k, [ _, mod_key, state ] in multipurpose_map.items():
             if k in _pressed_keys and mod_key not in _pressed_modifier_keys:
-                on_key(mod_key, Action.PRESS)
+                on_key(mod_key, Action.PRESS, context=context)
 
     # we need to register the last key presses so we know if a multipurpose key
     # was a single press and release
@@ -437,18 +664,25 @@ def multipurpose_handler(multipurpose_map, key, action):
 
         update_pressed_keys(key, action)
         if action == Action.RELEASE and key_is_down:
+            cancel_multipurpose_hold(key)
             # it is a single press and release
-            if key_was_last_press and _last_key_time + _timeout > int(monotonic()*1000):
+            if key_was_last_press and key not in _multipurpose_held_keys \
+               and _last_key_time + _timeout > int(event_time(context) * 1000):
                 maybe_press_modifiers(multipurpose_map)  # maybe other multipurpose keys are down
-                on_key(single_key, Action.PRESS)
-                on_key(single_key, Action.RELEASE)
+                on_key(single_key, Action.PRESS, context=context)
+                on_key(single_key, Action.RELEASE, context=context)
             # it is the modifier in a combo
             elif mod_is_down:
-                on_key(mod_key, Action.RELEASE)
+                on_key(mod_key, Action.RELEASE, context=context)
+            _multipurpose_held_keys.discard(key)
         elif action == Action.PRESS and not key_is_down:
-            _last_key_time = int(monotonic() * 1000) # obtain the milli-seconds
+            _last_key_time = int(event_time(context) * 1000) # obtain the milli-seconds
+            if _multipurpose_hold_threshold is not None:
+                _multipurpose_hold_timers[key] = call_at(
+                    event_time(context) + _multipurpose_hold_threshold / 1000.0,
+                    lambda: commit_multipurpose_hold(key, mod_key))
     # if key is not a multipurpose or mod key we want eventual modifiers down
-    elif (key not in Modifier.get_all_keys()) and action == Action.PRESS:
+    elif not Modifier.is_modifier_key(key) and action == Action.PRESS:
         maybe_press_modifiers(multipurpose_map)
 
     # we want to register all key-presses
@@ -456,66 +690,108 @@ def multipurpose_handler(multipurpose_map, key, action):
         _last_key = key
 
 
-def simultaneous_on_key(key, action, wm_class=None, quiet=False):
-    global _last_simul_key
+def commit_multipurpose_hold(key, mod_key):
+    """Send the modifier of a multipurpose key held past the hold threshold"""
+    _multipurpose_hold_timers.pop(key, None)
+    if key in _pressed_keys:
+        _multipurpose_held_keys.add(key)
+        if mod_key not in _pressed_modifier_keys:
+            on_key(mod_key, Action.PRESS)
+
+
+def cancel_multipurpose_hold(key):
+    timer = _multipurpose_hold_timers.pop(key, None)
+    if timer:
+        cancel_timer(timer)
+
+
+def simultaneous_on_key(key, action, context=None, quiet=False):
     global _last_key_time
     global _simultaneous_mappings 
     global _simultaneous_single_key_mappings
     # if given key was a mod key, simply send it
-    if key in Modifier.get_all_keys():
+    if Modifier.is_modifier_key(key):
         update_pressed_modifier_keys(key, action)
         send_key_action(key, action)
         return
     # if key was not pressed, send that action as well
     elif not action.is_pressed():
         if (key) in _simultaneous_single_key_mappings and key == _last_simul_key:
-            simul_transform_key(key, None, action, wm_class=wm_class, quiet=quit)
-            _last_simul_key = None
-            _last_key_time = monotonic()
+            simul_transform_key(key, None, action, context=context, quiet=quiet)
+            set_last_simul_key(None)
+            _last_key_time = event_time(context)
         if is_pressed(key):
             send_key_action(key, action)
         return
     # if modkey was already pressed, do usual transform
     if(len(_pressed_modifier_keys) > 0):
-        transform_key(key, action, wm_class=wm_class, quiet=quiet)
+        transform_key(key, action, context=context, quiet=quiet)
         return
 
     # if the action was PRESS, check if there is a corresponding map..
     if action == Action.PRESS:
         # if there is a corresponding map, send the sequence
-        if (key, _last_simul_key) in _simultaneous_mappings and (int((monotonic() - _last_key_time)*1000) < _simultaneous_key_timeout ):
+        if (key, _last_simul_key) in _simultaneous_mappings and (int((event_time(context) - _last_key_time)*1000) < _simultaneous_key_timeout ):
             # here comes transform process
-            simul_transform_key(key, _last_simul_key, action, wm_class=wm_class, quiet=quit)
-            _last_simul_key = None
-            _last_key_time = monotonic()
+            simul_transform_key(key, _last_simul_key, action, context=context, quiet=quiet)
+            set_last_simul_key(None)
+            _last_key_time = event_time(context)
         # corresponding map was found, but pressed too late..
         elif (key, _last_simul_key) in _simultaneous_mappings:
             # ... so we'll send the last key and store current key
-            simul_transform_key(_last_simul_key, None, action, wm_class=wm_class, quiet=quit)
-            _last_simul_key = key
-            _last_key_time = monotonic()
+            simul_transform_key(_last_simul_key, None, action, context=context, quiet=quiet)
+            set_last_simul_key(key, context)
+            _last_key_time = event_time(context)
         # if there is no corresponding map, look for an entry in single-type case
         elif (key) in _simultaneous_single_key_mappings and _last_simul_key == None:
-            _last_simul_key = key
-            _last_key_time = monotonic()
+            set_last_simul_key(key, context)
+            _last_key_time = event_time(context)
         # key combination is NOT in the mapping, but we need to handle the last-pressed key as well..
         elif (_last_simul_key) in _simultaneous_single_key_mappings:
-            simul_transform_key(_last_simul_key, None, action, wm_class=wm_class, quiet=quit)
-            _last_simul_key = key
-            _last_key_time = monotonic()
+            simul_transform_key(_last_simul_key, None, action, context=context, quiet=quiet)
+            set_last_simul_key(key, context)
+            _last_key_time = event_time(context)
         # if there is no corresponding map, simply store that key
         else:
-            on_key(key, action, wm_class=wm_class, quiet=quiet)
+            on_key(key, action, context=context, quiet=quiet)
             update_pressed_keys(key, action)
-            _last_simul_key = None
-            _last_key_time = monotonic()
+            set_last_simul_key(None)
+            _last_key_time = event_time(context)
             #on_key(key, action)
     ## we'll also need to consider the oya-key released
     #if action == Action.RELEASE: 
     #    pass
     return
 
-def simul_transform_key(key, last_key, action, wm_class=None, quiet=False):
+
+def set_last_simul_key(key, context=None):
+    """Store the key waiting for its simultaneous counterpart (None to clear)
+
+    A key with a single-key mapping is sent by a timer once the simultaneous
+    key timeout expires (counted from the time of the event in context),
+    rather than on the next key event.
+    """
+    global _last_simul_key
+    global _simultaneous_flush_timer
+    if _simultaneous_flush_timer:
+        cancel_timer(_simultaneous_flush_timer)
+        _simultaneous_flush_timer = None
+    _last_simul_key = key
+    if key in _simultaneous_single_key_mappings:
+        _simultaneous_flush_timer = call_at(event_time(context) + _simultaneous_key_timeout / 1000.0,
+                                            flush_last_simul_key)
+
+
+def flush_last_simul_key():
+    global _simultaneous_flush_timer
+    _simultaneous_flush_timer = None
+    key = _last_simul_key
+    if key is not None:
+        set_last_simul_key(None)
+        simul_transform_key(key, None, Action.PRESS)
+
+
+def simul_transform_key(key, last_key, action, context=None, quiet=False):
     if last_key == None:
         handle_commands(_simultaneous_single_key_mappings[(key)], None, action)
     else:
@@ -530,9 +806,46 @@ def simul_transform_key(key, last_key, action, wm_class=None, quiet=False):
     return
 
 
-def on_event(event, device_name, quiet):
-    key = Key(event.code)
-    action = Action(event.value)
+class EventContext(object):
+    """State of a single input event shared by every stage of on_event()
+
+    The WM_CLASS is looked up on first access only, so the X server is queried
+    at most once per event and not at all when nothing depends on it.
+    """
+
+    __slots__ = ('device_name', 'timestamp', 'active_mod_map', 'active_multipurpose_map', '_wm_class')
+
+    def __init__(self, device_name, timestamp):
+        self.device_name = device_name
+        self.timestamp = timestamp
+        self.active_mod_map = None
+        self.active_multipurpose_map = None
+        self._wm_class = None
+
+    @property
+    def wm_class(self):
+        if self._wm_class is None:
+            self._wm_class = get_active_window_wm_class()
+        return self._wm_class
+
+
+def event_time(context):
+    """Time of the event being handled (in seconds on the monotonic clock)"""
+    return context.timestamp if context else monotonic()
+
+
+def on_event(event, device_name, quiet, timestamp=None):
+    on_key_event(event.code, event.value, device_name, quiet, timestamp)
+
+
+def on_key_event(code, value, device_name, quiet, timestamp=None):
+    """Handle an EV_KEY event given as raw code and value
+
+    timestamp is the time of the event on the monotonic clock (e.g., from the
+    kernel), which defaults to the time it is handled.
+    """
+    key = decode_key(code)
+    action = decode_action(value)
     global _simultaneous_layout_switch
     global _simultaneous_toggle_key
 
@@ -541,53 +854,55 @@ def on_event(event, device_name, quiet):
     if key in _simultaneous_toggle_keys and action.is_pressed():
         toggle_simul_switch()
 
-    wm_class = None
+    context = EventContext(device_name, monotonic() if timestamp is None else timestamp)
+
     # translate keycode (like xmodmap)
     active_mod_map = _mod_map
-    if _conditional_mod_map:
-        wm_class = get_active_window_wm_class()
-        for condition, mod_map in _conditional_mod_map:
-            params = [wm_class]
-            if len(signature(condition).parameters) == 2:
-                params = [wm_class, device_name]
-
-            if condition(*params):
-                # condition is met => store the given mod_map
-                active_mod_map = mod_map
-                break
+    for condition, mod_map in _conditional_mod_map:
+        if condition(context.wm_class, device_name):
+            # condition is met => store the given mod_map
+            active_mod_map = mod_map
+            break
+    context.active_mod_map = active_mod_map
     if active_mod_map and key in active_mod_map:
         # specified key is in the modmap => replace the key
         key = active_mod_map[key]
 
+    if _delayed_command_keys and is_delayed_key(key):
+        # keep the order of the key events relative to the delayed commands
+        _delayed_events.append((key, action, context, quiet))
+        return
+
+    on_translated_key(key, action, context, quiet)
+
+
+def on_translated_key(key, action, context, quiet):
+    """Handle a key event after the modmap translation"""
     active_multipurpose_map = _multipurpose_map
-    if _conditional_multipurpose_map:
-        wm_class = get_active_window_wm_class()
-        for condition, mod_map in _conditional_multipurpose_map:
-            params = [wm_class]
-            if len(signature(condition).parameters) == 2:
-                params = [wm_class, device_name]
-            if condition(*params):
-                active_multipurpose_map = mod_map
-                break
+    for condition, mod_map in _conditional_multipurpose_map:
+        if condition(context.wm_class, context.device_name):
+            active_multipurpose_map = mod_map
+            break
+    context.active_multipurpose_map = active_multipurpose_map
     if active_multipurpose_map:
-        multipurpose_handler(active_multipurpose_map, key, action)
+        multipurpose_handler(active_multipurpose_map, key, action, context=context)
         if key in active_multipurpose_map:
             return
 
     # from here the clause of simultaneous key event handlings..
     # we'd like to avoid 
     if _simultaneous_mappings and _simultaneous_layout_switch:
-        simultaneous_on_key(key, action, wm_class=wm_class, quiet=quiet)
+        simultaneous_on_key(key, action, context=context, quiet=quiet)
         return
     # simultaneous key event handling until here..
 
     # it is not about multipurpose process, so just send it to on_key()
-    on_key(key, action, wm_class=wm_class, quiet=quiet)
+    on_key(key, action, context=context, quiet=quiet)
     update_pressed_keys(key, action)
 
 
-def on_key(key, action, wm_class=None, quiet=False):
-    if key in Modifier.get_all_keys():
+def on_key(key, action, context=None, quiet=False):
+    if Modifier.is_modifier_key(key):
         update_pressed_modifier_keys(key, action)
         send_key_action(key, action)
     elif not action.is_pressed():
@@ -596,47 +911,50 @@ def on_key(key, action, wm_class=None, quiet=False):
             send_key_action(key, action)
     else:
     # otherwise send the key to transform process
-        transform_key(key, action, wm_class=wm_class, quiet=quiet)
+        transform_key(key, action, context=context, quiet=quiet)
+
 
+# Name of the top-level keymap the current mode (multi-stroke keys) was entered from
+_mode_keymap_name = None
 
-def transform_key(key, action, wm_class=None, quiet=False):
+
+def transform_key(key, action, context=None, quiet=False):
     global _mode_maps
     global _toplevel_keymaps
 
-    combo = Combo(get_pressed_modifiers(), key)
+    modifier_masks = generalize_modifier_mask(_pressed_modifier_mask)
 
     if _mode_maps is escape_next_key:
-        print("Escape key: {}".format(combo))
+        print("Escape key: {}".format(Combo(get_pressed_modifiers(), key)))
         send_key_action(key, action)
         _mode_maps = None
         return
 
+    global _mode_keymap_name
+
     is_top_level = False
     if _mode_maps is None:
         # Decide keymap(s)
         is_top_level = True
-        _mode_maps = []
-        if wm_class is None:
-            wm_class = get_active_window_wm_class()
-        keymap_names = []
-        for condition, mappings, name in _toplevel_keymaps:
-            if (callable(condition) and condition(wm_class)) \
-               or (hasattr(condition, "search") and condition.search(wm_class)) \
-               or condition is None:
-                _mode_maps.append(mappings)
-                keymap_names.append(name)
+        wm_class = context.wm_class if context else get_active_window_wm_class()
+        mappings, keymap_names = get_active_keymaps(wm_class)
+        _mode_maps = [mappings]
         if not quiet:
             print("WM_CLASS '{}' | active keymaps = [{}]".format(wm_class, ", ".join(keymap_names)))
 
     if not quiet:
-        print(combo)
+        print(Combo(get_pressed_modifiers(), key))
 
     # _mode_maps: [global_map, local_1, local_2, ...]
     for mappings in _mode_maps:
-        if combo not in mappings:
+        entry = lookup_keymap(mappings, modifier_masks, key)
+        if entry is None:
             continue
+        if is_top_level:
+            _mode_keymap_name = keymap_names[entry[0]]
+        note_decision(_mode_keymap_name)
         # Found key in "mappings". Execute commands defined for the key.
-        reset_mode = handle_commands(mappings[combo], key, action)
+        reset_mode = handle_commands(entry[1], key, action)
         if reset_mode:
             _mode_maps = None
         return
@@ -644,6 +962,7 @@ def transform_key(key, action, wm_class=None, quiet=False):
     # Not found in all keymaps
     if is_top_level:
         # If it's top-level, pass through keys
+        note_decision(None)
         send_key_action(key, action)
 
     _mode_maps = None
@@ -657,23 +976,35 @@ def handle_commands(commands, key, action):
 
     if not isinstance(commands, list):
         commands = [commands]
+    commands = deque(commands)
 
     # Execute commands
-    for command in commands:
+    while commands:
+        command = commands.popleft()
         if callable(command):
-            reset_mode = handle_commands(command(), key, action)
-            if reset_mode:
-                return True
-
-        if isinstance(command, Key):
+            # The returned value is executed in place of the function
+            result = command()
+            if isinstance(result, list):
+                commands.extendleft(reversed(result))
+            elif result is not None:
+                commands.appendleft(result)
+        elif isinstance(command, Key):
             send_key(command)
         elif isinstance(command, Combo):
             send_combo(command)
+        elif isinstance(command, Macro):
+            send_macro(command)
+        elif isinstance(command, Delay):
+            delay_commands(command.seconds, list(commands), key, action)
+            return True
         elif command is escape_next_key:
             _mode_maps = escape_next_key
             return False
         # Go to next keymap
         elif isinstance(command, dict):
+            if not isinstance(command, CompiledKeymap):
+                # e.g., a keymap returned by a function
+                command = compile_keymap(command)
             _mode_maps = [command]
             return False
         elif command is pass_through_key:
@@ -681,3 +1012,47 @@ def handle_commands(commands, key, action):
             return True
     # Reset keymap in ordinary flow
     return True
+
+
+# ============================================================
+# Delayed commands
+# ============================================================
+
+# Keys touched by the commands waiting for a Delay (a set per command list)
+_delayed_command_keys = []
+# Key events of those keys, handled once the commands have been executed
+_delayed_events = []
+
+
+def is_delayed_key(key):
+    for keys in _delayed_command_keys:
+        if key in keys:
+            return True
+    return False
+
+
+def delay_commands(seconds, commands, key, action):
+    """Execute commands after seconds without blocking the event loop"""
+    touched_keys = {key} if key is not None else set()
+    for command in commands:
+        if isinstance(command, Key):
+            touched_keys.add(command)
+        elif isinstance(command, Combo):
+            touched_keys.add(command.key)
+        elif isinstance(command, Macro):
+            touched_keys.update(combo.key for combo in command.combos)
+    _delayed_command_keys.append(touched_keys)
+
+    def resume():
+        _delayed_command_keys.remove(touched_keys)
+        handle_commands(commands, key, action)
+        # Handle the key events held back meanwhile (unless still delayed)
+        events = _delayed_events[:]
+        del _delayed_events[:]
+        for event in events:
+            if is_delayed_key(event[0]):
+                _delayed_events.append(event)
+            else:
+                on_translated_key(*event)
+
+    call_later(seconds, resume)